@@ -26,6 +26,11 @@ True
 
 from collections import Counter
 
+import numpy as np
+
+# Up to this many variables, count_variables uses str.count per variable
+_COUNT_MAX_VARIABLES = 4
+
 
 def _check_production_rule(p):
     if len(p) != 1:
@@ -54,6 +59,7 @@ class Lsys(dict):
         for p in P:
             _check_production_rule(p)
         super(Lsys, self).__init__(P)
+        self._invalidate()
 
     def __missing__(self, key):
         return key
@@ -78,10 +84,88 @@ class Lsys(dict):
         """
         _check_production_rule(key)
         super(Lsys, self).__setitem__(key, value)
+        self._invalidate()
+
+    def __delitem__(self, key):
+        """
+        >>> d = Lsys({'A': 'B', 'B': 'C'})
+        >>> del d['B']
+        >>> d.variables(), d.constants() == {'B'}
+        ({'A'}, True)
+        """
+        super(Lsys, self).__delitem__(key)
+        self._invalidate()
+
+    def pop(self, *args):
+        value = super(Lsys, self).pop(*args)
+        self._invalidate()
+        return value
+
+    def popitem(self):
+        item = super(Lsys, self).popitem()
+        self._invalidate()
+        return item
+
+    def setdefault(self, key, default=None):
+        _check_production_rule(key)
+        value = super(Lsys, self).setdefault(key, default)
+        self._invalidate()
+        return value
+
+    def update(self, *args, **kwargs):
+        """
+        >>> d = Lsys({'A': 'B'})
+        >>> d.update({'B': 'C'})
+        >>> d.variables() == {'A', 'B'}
+        True
+        """
+        super(Lsys, self).update(*args, **kwargs)
+        self._invalidate()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super(Lsys, self).clear()
+        self._invalidate()
+
+    def _invalidate(self):
+        """ Drop all lookup tables derived from the rules """
+        self._trans = None
+        self._vars_cache = None
+        self._consts_cache = None
+        self._var_lut = None
+        self._productive = None
+
+    def _translation(self):
+        """
+        Translation table from code points to production results, usable with
+        :code:`str.translate`. Symbols without a rule are not in the table and
+        thus left unchanged, just like with :code:`__missing__`.
+        """
+        if self._trans is None:
+            self._trans = {ord(k): v for k, v in self.items()}
+        return self._trans
+
+    def _variables(self):
+        """ Cached frozenset of variables, dropped when the rules change """
+        if self._vars_cache is None:
+            # Keys are only allowed to be single symbols
+            self._vars_cache = frozenset(self.keys())
+        return self._vars_cache
+
+    def _constants(self):
+        """ Cached frozenset of constants, dropped when the rules change """
+        if self._consts_cache is None:
+            # Values may have multiple symbols
+            self._consts_cache = frozenset(''.join(self.values())) \
+                - self._variables()
+        return self._consts_cache
 
     def variables(self):
         """
-        Return set of variables, do not cache, rules may have changed
+        Return set of variables, a fresh copy since rules may change
         >>> l = Lsys({'S': 'BB'})
         >>> l.variables()
         {'S'}
@@ -89,8 +173,7 @@ class Lsys(dict):
         >>> l.variables() == {'S', 'B'}
         True
         """
-        # Keys are only allowed to be single symbols
-        return set(self.keys())
+        return set(self._variables())
 
     def constants(self):
         """
@@ -98,8 +181,7 @@ class Lsys(dict):
         >>> l.constants()
         {'B'}
         """
-        # Values may have multiple symbols
-        return set(''.join(self.values())) - self.variables()
+        return set(self._constants())
 
     def alphabet(self):
         """
@@ -108,7 +190,7 @@ class Lsys(dict):
         >>> l.alphabet() == {'S', 'B'}
         True
         """
-        return self.variables() | self.constants()
+        return set(self._variables() | self._constants())
 
     def __call__(self, input):
         """
@@ -119,19 +201,181 @@ class Lsys(dict):
         >>> it = algae(it)
         >>> it
         'ABA'
+        >>> Lsys({'A': 'B', 'B': 'A'})('ABC')
+        'BAC'
+
+        Since all left-hand sides are single symbols, :code:`str.translate`
+        covers rules of any length, including erasing ones, and sizes the
+        output in C. It equals joining the productions of all symbols:
+
+        >>> l = Lsys({'F': 'F+F-F-F+F', '-': ''})
+        >>> l('F-F') == ''.join(l[s] for s in 'F-F')
+        True
+        >>> l('F-F')
+        'F+F-F-F+FF+F-F-F+F'
         """
-        symbols, output = str(input), ''
-        for symbol in symbols:
-            output += self[symbol]
-        return output
+        return str(input).translate(self._translation())
+
+    def _reachable(self, input, n):
+        """
+        Variables to expand per level for :code:`self.apply(input, n)`: entry
+        k holds the variables whose expansion after k applications is part of
+        the result, entry n those of :code:`input` itself.
+        """
+        variables = self._variables()
+        needed = [frozenset()] * (n + 1)
+        needed[n] = variables.intersection(input)
+        for k in range(n, 1, -1):
+            below = variables.intersection(
+                ''.join(self[v] for v in needed[k]))
+            if below == needed[k]:
+                # all lower levels need the same variables
+                needed[1:k] = [below] * (k - 1)
+                break
+            needed[k - 1] = below
+        return needed
+
+    def _expansion(self, input, n):
+        """
+        Translation table mapping the variables of :code:`input` to their
+        expansion after :code:`n` applications. Level k is obtained by
+        translating the rules with level k - 1, so each reachable variable is
+        expanded once per level. Only the previous level is kept.
+        """
+        table = {}
+        for variables in self._reachable(input, n)[1:]:
+            table = {ord(v): self[v].translate(table) for v in variables}
+        return table
 
     def apply(self, input, n=1):
         """
         Apply :code:`self` to :code:`input` :code:`n` times.
+        Intermediate generations of :code:`input` are never built, instead the
+        expansions of the variables reachable from :code:`input` are built
+        level by level and joined in a single pass.
+        >>> algae = Lsys({'A': 'AB', 'B': 'A'})
+        >>> algae.apply('A', 5)
+        'ABAABABAABAAB'
+        >>> algae.apply('BA', 2) == algae(algae('BA'))
+        True
+        >>> algae['B'] = 'C'
+        >>> algae.apply('A', 3)
+        'ABCC'
+        >>> Lsys({'A': 'A', 'B': 'BB'}).apply('A', 100)  # B is never expanded
+        'A'
         """
-        for __ in range(n):
-            input = self(input)
-        return input
+        if n < 1:
+            return input
+        input = str(input)
+        return input.translate(self._expansion(input, n))
+
+    def generate(self, input, n=1):
+        """
+        Yield the symbols of :code:`self.apply(input, n)` one by one,
+        expanding depth-first such that the string is never built. Memory
+        stays proportional to :code:`n` instead of the result length.
+        >>> algae = Lsys({'A': 'AB', 'B': 'A'})
+        >>> ''.join(algae.generate('A', 5)) == algae.apply('A', 5)
+        True
+        >>> ''.join(Lsys({'A': 'AB', 'B': ''}).generate('AXB', 3))
+        'ABX'
+        """
+        get = self.get
+        stack = [(iter(str(input)), n)]
+        while stack:
+            symbols, depth = stack[-1]
+            for symbol in symbols:
+                production = get(symbol) if depth else None
+                if production is None:
+                    yield symbol
+                else:
+                    stack.append((iter(production), depth - 1))
+                    break
+            else:
+                stack.pop()
+
+    def apply_bytes(self, input, n=1):
+        """
+        Apply :code:`self` to the bytes :code:`input` :code:`n` times. Each
+        byte is one latin-1 symbol, so the productions of all variables
+        reachable from :code:`input` must be latin-1 as well. The expansions
+        are built level by level as bytes, the result can be viewed without
+        copying by :code:`np.frombuffer`.
+        >>> algae = Lsys({'A': 'AB', 'B': 'A'})
+        >>> algae.apply_bytes(b'A', 5)
+        b'ABAABABAABAAB'
+        >>> Lsys({'A': 'B', 'B': 'A'}).apply_bytes(b'ABC', 3)
+        b'BAC'
+        >>> Lsys({'A': '\u03b1', 'B': 'A'}).apply_bytes(b'B', 2)
+        ... # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        UnicodeEncodeError: 'latin-1' codec can't encode character ...
+        """
+        input = bytes(input)
+        if n < 1:
+            return input
+        identity = [bytes((i,)) for i in range(256)]
+        table = identity
+        for variables in self._reachable(map(chr, set(input)), n)[1:]:
+            previous, table = table, identity[:]
+            for v in variables:
+                production = self[v].encode('latin-1')
+                table[ord(v)] = b''.join(map(previous.__getitem__, production))
+        if all(len(b) == 1 for b in table):
+            return input.translate(b''.join(table))
+        return b''.join(map(table.__getitem__, input))
+
+    def rule_matrix(self, symbols=None):
+        """
+        Count matrix of the production rules: entry :code:`(i, j)` is the
+        number of occurrences of :code:`symbols[j]` in the production of
+        :code:`symbols[i]`. Symbols default to the sorted alphabet. Entries are
+        python ints (object dtype), such that matrix powers do not overflow.
+        >>> algae = Lsys({'A': 'AB', 'B': 'A'})
+        >>> algae.rule_matrix()
+        array([[1, 1],
+               [1, 0]], dtype=object)
+        """
+        if symbols is None:
+            symbols = sorted(self._variables() | self._constants())
+        index = {s: i for i, s in enumerate(symbols)}
+        M = np.zeros((len(symbols), len(symbols)), dtype=object)
+        for i, s in enumerate(symbols):
+            for t, k in Counter(self[s]).items():
+                M[i, index[t]] = k
+        return M
+
+    def symbol_counts_after(self, input, n=1):
+        """
+        Occurrences of each symbol in :code:`self.apply(input, n)`, computed
+        from powers of the rule matrix without ever building the string.
+        >>> algae = Lsys({'A': 'AB', 'B': 'A'})
+        >>> algae.symbol_counts_after('A', 5) == Counter(algae.apply('A', 5))
+        True
+        >>> algae.symbol_counts_after('AAB', -1)
+        Counter({'A': 2, 'B': 1})
+        """
+        input = str(input)
+        symbols = sorted(self._variables() | self._constants() | set(input))
+        initial = Counter(input)
+        v = np.array([initial[s] for s in symbols], dtype=object)
+        if n >= 1:  # like apply, n < 1 leaves the input unchanged
+            v = v @ np.linalg.matrix_power(self.rule_matrix(symbols), n)
+        return Counter({s: int(k) for s, k in zip(symbols, v) if k})
+
+    def length_after(self, input, n=1):
+        """
+        Length of :code:`self.apply(input, n)`, without building the string.
+        Lengths grow by a linear recurrence, so this is cheap even for large n.
+        >>> algae = Lsys({'A': 'AB', 'B': 'A'})
+        >>> [algae.length_after('A', n) for n in range(8)]
+        [1, 2, 3, 5, 8, 13, 21, 34]
+        >>> algae.length_after('A', 100)
+        927372692193078999176
+        >>> algae.length_after('AB', -3) == len(algae.apply('AB', -3))
+        True
+        """
+        return sum(self.symbol_counts_after(input, n).values())
 
     def count_variables(self, input):
         """
@@ -141,9 +385,28 @@ class Lsys(dict):
         4
         >>> d.count_variables('BBBDDD')
         0
+        >>> d.count_variables('A\u00e4C')
+        2
+        >>> many = Lsys({v: 'x' for v in 'ABCDEFGHIJ'})
+        >>> many.count_variables('AxBJJ'), many.count_variables('A\u00e4J')
+        (4, 2)
+        >>> many.count_variables(['A', 'x']), d.count_variables(iter('AC'))
+        (1, 2)
         """
+        variables = self._variables()
+        if isinstance(input, str) and len(variables) <= _COUNT_MAX_VARIABLES:
+            # one C-level scan per variable beats a full pass for few of them
+            return sum(input.count(v) for v in variables)
+        if isinstance(input, str) and input.isascii():
+            if self._var_lut is None:
+                # Lookup table over byte codes, marks the (ASCII) variables
+                codes = [ord(v) for v in variables if v.isascii()]
+                self._var_lut = np.zeros(256, dtype=bool)
+                self._var_lut[codes] = True
+            buf = np.frombuffer(input.encode('ascii'), dtype=np.uint8)
+            return int(np.count_nonzero(self._var_lut[buf]))
         c = Counter(input)
-        return sum(c[v] for v in self.variables())
+        return sum(c[v] for v in variables)
 
     def contains_variable(self, input):
         """ Faster than count_variables > 0 for checking an input
@@ -158,12 +421,34 @@ class Lsys(dict):
         True
         >>> d.contains_variable('')
         False
+        >>> Lsys({']': '[', '^': 'A'}).contains_variable('X^')
+        True
+        >>> Lsys({}).contains_variable('X')
+        False
+        >>> Lsys({'A': 'B'}).contains_variable(['A', 'x'])
+        True
         """
-        for v in self.variables():
-            if v in input:
-                return True
-        else:
-            return False
+        # str.__contains__ finds a single symbol with a fast C search
+        return any(v in input for v in self._variables())
+
+    def _productive_variables(self):
+        """
+        Cached frozenset of variables that keep producing variables forever:
+        the largest set of variables whose productions each contain one of
+        them. Once the input contains one, so do all later generations.
+        >>> Lsys({'A': 'AB', 'B': 'C', 'D': 'B'})._productive_variables()
+        frozenset({'A'})
+        """
+        if self._productive is None:
+            productive = self._variables()
+            while True:
+                shrunk = frozenset(v for v in productive
+                                   if not productive.isdisjoint(self[v]))
+                if shrunk == productive:
+                    break
+                productive = shrunk
+            self._productive = productive
+        return self._productive
 
     def iter(self, input, max_iter=None):
         """
@@ -182,10 +467,23 @@ class Lsys(dict):
         >>> algae['B'] = 'X'
         >>> next(gen)
         'XXX'
+
+        Without :code:`max_iter`, iteration stops once no variables are left
+        >>> list(Lsys({'A': 'B', 'B': 'C'}).iter('AA'))
+        ['BB', 'CC']
         """
         if max_iter is None:
-            input = self(input)
-            yield input
+            productive = None
+            while True:
+                input = self(input)
+                yield input
+                if productive is not self._productive_variables():
+                    # (re)check, initially or since the rules have changed
+                    productive = self._productive_variables()
+                    endless = not productive.isdisjoint(input)
+                # Only scan while no productive variable was seen
+                if not endless and not self.contains_variable(input):
+                    break
         else:
             for __ in range(max_iter):
                 input = self(input)
@@ -5,18 +5,48 @@ from linsys import Lsys
 import matplotlib.pyplot as plt
 import sys
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Unit directions for the discrete angles used by the turtles (in degrees)
+_DIRECTIONS = {a: (math.cos(a * math.pi / 180.), math.sin(a * math.pi / 180.))
+               for a in range(0, 360, 5)}
+
+# Below this many symbols, JIT warmup outweighs the interpreter overhead
+NATIVE_MIN_SYMBOLS = 4096
+
 
 class Turtle(ABC):
-    def __init__(self):
+    def __init__(self, capacity=64):
+        self.reset(capacity)
+
+    def reset(self, capacity=64):
+        # back to the initial state with a fresh trace, handed out traces stay
         self.position = (0, 0)
         self.angle = 90
-        self.trace = []
+        self._trace = np.empty((max(capacity, 1), 2))
+        self._n = 0
+
+    @property
+    def trace(self):
+        return self._trace[:self._n]
+
+    def reserve(self, capacity):
+        # double on overflow, such that poop stays amortized O(1)
+        if capacity > len(self._trace):
+            trace = np.empty((max(capacity, 2 * len(self._trace)), 2))
+            trace[:self._n] = self._trace[:self._n]
+            self._trace = trace
 
     def move(self, step=1.0):
         # we could normalize direction
         x, y = self.position
-        rad = self.angle * math.pi / 180.
-        direction = (math.cos(rad), math.sin(rad))
+        direction = _DIRECTIONS.get(self.angle % 360)
+        if direction is None:
+            rad = self.angle * math.pi / 180.
+            direction = (math.cos(rad), math.sin(rad))
         x += step * direction[0]
         y += step * direction[1]
         self.position = (x, y)
@@ -25,27 +55,164 @@ class Turtle(ABC):
         self.angle += degree
 
     def poop(self):
-        self.trace.append(tuple(self.position))
+        if self._n == len(self._trace):
+            self.reserve(self._n + 1)
+        self._trace[self._n] = self.position
+        self._n += 1
 
     @abstractmethod
     def feed(self, symbol):
         pass
 
     def __call__(self, symbols):
+        if isinstance(symbols, (bytes, bytearray)):
+            symbols = symbols.decode('latin-1')
+        if hasattr(symbols, '__len__'):
+            # each symbol leaves at most one trace point
+            self.reserve(self._n + len(symbols))
+        feed = self.feed  # bind once, not per symbol
         for symbol in symbols:
-            self.feed(symbol)
+            feed(symbol)
         return self
 
+    def grow(self, lsys, axiom, n=1):
+        # same as self(lsys.apply(axiom, n)), without building the string
+        return self(lsys.generate(axiom, n))
+
     # Output formats
 
     def numpy(self):
-        return np.asarray(self.trace)
+        return self.trace
+
+
+def _tree_cumsum(values, parents):
+    # Sums values along parent pointers (-1 marks a root) by pointer jumping,
+    # which takes O(log depth) vectorized steps instead of a python loop
+    total, parents = values.copy(), parents.copy()
+    active = np.flatnonzero(parents >= 0)
+    while active.size:
+        up = parents[active]
+        total[active] += total[up]
+        parents[active] = parents[up]
+        active = active[parents[active] >= 0]
+    return total
+
+
+def _fractal_step(c, trace, n, x, y, angle, stack_xy, stack_ang, sp):
+    # FractalTree.feed for a single byte code, returns the new state
+    if c == 48 or c == 49:  # '0' or '1'
+        rad = angle * math.pi / 180.
+        x += math.cos(rad)
+        y += math.sin(rad)
+        trace[n, 0] = x
+        trace[n, 1] = y
+        n += 1
+    elif c == 91:  # '['
+        stack_xy[sp, 0] = x
+        stack_xy[sp, 1] = y
+        stack_ang[sp] = angle
+        sp += 1
+        angle -= 45.
+    elif c == 93:  # ']'
+        if sp == 0:
+            raise IndexError('pop from empty stack')
+        sp -= 1
+        x = stack_xy[sp, 0]
+        y = stack_xy[sp, 1]
+        angle = stack_ang[sp] + 45.
+    return n, x, y, angle, sp
+
+
+def _fractal_walk(codes, trace, n, x, y, angle, stack_xy, stack_ang, sp):
+    # FractalTree.feed over byte codes, fills trace from row n onwards
+    for i in range(codes.size):
+        n, x, y, angle, sp = _fractal_step(
+            codes[i], trace, n, x, y, angle, stack_xy, stack_ang, sp)
+    return n, x, y, angle, sp
+
+
+def _fractal_grow(codes, start, end, axiom, depth,
+                  trace, n, x, y, angle, stack_xy, stack_ang, sp):
+    # Expands codes[axiom:] depth times depth-first and feeds the resulting
+    # symbols to the walk right away, the rules of byte code c are
+    # codes[start[c]:end[c]] (start[c] < 0 if c is a constant).
+    # Returns the stack as well, since it grows here.
+    pos = np.empty(depth + 1, np.int64)
+    stop = np.empty(depth + 1, np.int64)
+    level, pos[0], stop[0] = 0, axiom, codes.size
+    while level >= 0:
+        if pos[level] == stop[level]:
+            level -= 1
+            continue
+        c = codes[pos[level]]
+        pos[level] += 1
+        if level < depth - 1 and start[c] >= 0:
+            level += 1
+            pos[level], stop[level] = start[c], end[c]
+            continue
+        # the production of c (or c itself) is at full depth: feed it
+        if level < depth and start[c] >= 0:
+            first, last = start[c], end[c]
+        else:
+            first, last = pos[level] - 1, pos[level]
+        if sp + last - first > stack_ang.size:
+            capacity = 2 * (sp + last - first)
+            grown_xy = np.empty((capacity, 2))
+            grown_ang = np.empty(capacity)
+            grown_xy[:sp] = stack_xy[:sp]
+            grown_ang[:sp] = stack_ang[:sp]
+            stack_xy, stack_ang = grown_xy, grown_ang
+        for i in range(first, last):
+            n, x, y, angle, sp = _fractal_step(
+                codes[i], trace, n, x, y, angle, stack_xy, stack_ang, sp)
+    return n, x, y, angle, stack_xy, stack_ang, sp
+
+
+if njit is not None:
+    _fractal_step = njit(cache=True)(_fractal_step)
+    _fractal_walk = njit(cache=True)(_fractal_walk)
+    _fractal_grow = njit(cache=True)(_fractal_grow)
+
+
+def _bracket_cumsum(values, is_close, restore, jump):
+    # Cumulative sum of values, except that right after each ']' it restarts
+    # from the sum at index restore (before the matching '[', -1 for none)
+    # plus jump. Only the ']' need pointer jumping, in between it is a cumsum.
+    pad = np.zeros((1,) + values.shape[1:])
+    flat = np.concatenate([pad, np.cumsum(values, axis=0)])
+    segment = np.concatenate([[-1], np.cumsum(is_close) - 1])
+    starts = np.concatenate([[-1], np.flatnonzero(is_close)])
+    parent = segment[restore + 1]
+    offsets = flat[restore + 1] - flat[starts[parent + 1] + 1] + jump
+    at_close = np.concatenate([pad, _tree_cumsum(offsets, parent)])
+    segment = segment[1:]
+    return flat[1:] - flat[starts[segment + 1] + 1] + at_close[segment + 1]
 
 
 class FractalTree(Turtle):
-    def __init__(self):
-        super(FractalTree, self).__init__()
-        self.stack = []
+    def __init__(self, capacity=64):
+        # parallel arrays of saved positions and angles, _sp is the cursor
+        self._stack_xy = np.empty((64, 2))
+        self._stack_ang = np.empty(64)
+        super(FractalTree, self).__init__(capacity)
+
+    def reset(self, capacity=64):
+        # keeps the stack buffers for reuse
+        super(FractalTree, self).reset(capacity)
+        self._sp = 0
+
+    @property
+    def stack(self):
+        return [(tuple(self._stack_xy[i].tolist()), float(self._stack_ang[i]))
+                for i in range(self._sp)]
+
+    def reserve_stack(self, capacity):
+        if capacity > len(self._stack_ang):
+            capacity = max(capacity, 2 * len(self._stack_ang))
+            stack_xy, stack_ang = np.empty((capacity, 2)), np.empty(capacity)
+            stack_xy[:self._sp] = self._stack_xy[:self._sp]
+            stack_ang[:self._sp] = self._stack_ang[:self._sp]
+            self._stack_xy, self._stack_ang = stack_xy, stack_ang
 
     def feed(self, symbol):
         if symbol == '0':
@@ -56,26 +223,165 @@ class FractalTree(Turtle):
             self.move()
             self.poop()
         elif symbol == '[':
-            self.stack.append((self.position, self.angle))
+            if self._sp == len(self._stack_ang):
+                self.reserve_stack(self._sp + 1)
+            self._stack_xy[self._sp] = self.position
+            self._stack_ang[self._sp] = self.angle
+            self._sp += 1
             self.turn(-45)
         elif symbol == ']':
-            self.position, self.angle = self.stack.pop()
+            if self._sp == 0:
+                raise IndexError('pop from empty stack')
+            self._sp -= 1
+            self.position = tuple(self._stack_xy[self._sp].tolist())
+            self.angle = float(self._stack_ang[self._sp])
             self.turn(45)
 
+    def __call__(self, symbols):
+        if njit is None or not isinstance(symbols, (str, bytes, bytearray)) \
+                or len(symbols) < NATIVE_MIN_SYMBOLS:
+            return super(FractalTree, self).__call__(symbols)
+        if isinstance(symbols, str):
+            # non-ascii symbols are ignored by feed, so replacing them is fine
+            symbols = symbols.encode('ascii', 'replace')
+        codes = np.frombuffer(symbols, np.uint8)
+        self.reserve(self._n + len(codes))
+        self.reserve_stack(self._sp + symbols.count(b'['))
+        x, y = self.position
+        self._n, x, y, self.angle, self._sp = _fractal_walk(
+            codes, self._trace, self._n, float(x), float(y),
+            float(self.angle), self._stack_xy, self._stack_ang, self._sp)
+        self.position = (x, y)
+        return self
+
+    def grow(self, lsys, axiom, n=1):
+        """
+        Same as :code:`self(lsys.apply(axiom, n))`, but expands the rules
+        depth-first within the numba kernel (python generator without numba)
+        >>> fractal = Lsys({'1': '11', '0': '1[0]0'})
+        >>> def same(n):
+        ...     grown = FractalTree().grow(fractal, '0', n).numpy()
+        ...     walked = FractalTree()(fractal.apply('0', n)).numpy()
+        ...     return np.array_equal(grown, walked)
+        >>> all(same(n) for n in range(6))
+        True
+        >>> fractal.length_after('0', 12) >= NATIVE_MIN_SYMBOLS  # native
+        True
+        >>> same(12)
+        True
+        """
+        axiom = str(axiom)
+        symbols = ''.join(lsys) + ''.join(lsys.values()) + axiom
+        counts = lsys.symbol_counts_after(axiom, n)
+        if njit is None or not symbols.isascii() \
+                or sum(counts.values()) < NATIVE_MIN_SYMBOLS:
+            return super(FractalTree, self).grow(lsys, axiom, n)
+        # Rules and axiom as one byte buffer with offsets of the rules
+        start, end = np.full(256, -1, np.int64), np.full(256, -1, np.int64)
+        offset = 0
+        for variable, production in lsys.items():
+            start[ord(variable)], end[ord(variable)] = \
+                offset, offset + len(production)
+            offset += len(production)
+        codes = np.frombuffer(
+            (''.join(lsys.values()) + axiom).encode('ascii'), np.uint8)
+        self.reserve(self._n + counts['0'] + counts['1'])
+        x, y = self.position
+        self._n, x, y, self.angle, self._stack_xy, self._stack_ang, \
+            self._sp = _fractal_grow(
+                codes, start, end, offset, n,
+                self._trace, self._n, float(x), float(y), float(self.angle),
+                self._stack_xy, self._stack_ang, self._sp)
+        self.position = (x, y)
+        return self
+
+    def trace_numpy(self, symbols):
+        """
+        Trace of feeding symbols to the current state (position, angle and
+        saved stack) as numpy array, without modifying the turtle and without
+        a python loop over the symbols.
+        After ']' the turtle continues from the state before the matching '[',
+        otherwise from the state after the previous symbol. Angles and
+        positions are cumulative sums between ']', which are linked up by
+        pointer jumping. The saved stack enters as a prefix of '[', each
+        preceded by a pseudo symbol that steps to the saved state.
+        >>> def same(symbols, fed=''):
+        ...     turtle = FractalTree()(fed)
+        ...     traced, before = turtle.trace_numpy(symbols), turtle._n
+        ...     return np.allclose(traced, turtle(symbols).numpy()[before:])
+        >>> same('1[1[0]0]0'), same('1[[0]1[0'), same('[1[x0]]1')
+        (True, True, True)
+        >>> same('1]1', fed='1[1'), same('0]]1[0]', fed='1[1[0[')
+        (True, True)
+        >>> FractalTree().trace_numpy('').shape
+        (0, 2)
+        >>> same(Lsys({'1': '11', '0': '1[0]0'}).apply('0', 8))
+        True
+        >>> FractalTree().trace_numpy(']1')
+        Traceback (most recent call last):
+        IndexError: pop from empty stack
+        """
+        if isinstance(symbols, str):
+            symbols = symbols.encode('ascii', 'replace')
+        # Prefix: state 0, '[', ..., state k - 1, '[', current state
+        k = self._sp
+        states_xy = np.vstack([self._stack_xy[:k], [self.position]])
+        states_ang = np.append(self._stack_ang[:k], self.angle)
+        prefix = np.zeros(2 * k + 1, np.uint8)
+        prefix[1::2] = ord('[')
+        codes = np.concatenate([prefix, np.frombuffer(symbols, np.uint8)])
+        is_move = (codes == ord('0')) | (codes == ord('1'))
+        is_open, is_close = codes == ord('['), codes == ord(']')
+        # depth += ('[') - (']'), without branches
+        depth = np.cumsum(is_open.astype(np.intp) - is_close)
+        if depth.min() < 0:
+            raise IndexError('pop from empty stack')
+        # On each depth level, brackets alternate between '[' and ']', so a
+        # stable sort by level puts every ']' right after its matching '['
+        brackets = np.flatnonzero(is_open | is_close)
+        level = depth[brackets] + is_close[brackets]
+        brackets = brackets[np.argsort(level, kind='stable')]
+        closes = np.flatnonzero(is_close[brackets])
+        match = np.empty(len(codes), dtype=np.intp)
+        match[brackets[closes]] = brackets[closes - 1]
+        restore = match[is_close] - 1
+        turns = np.where(is_open, -45., 0.)
+        # pseudo symbols turn from the angle after the previous '['
+        turns[0:2 * k + 1:2] = np.diff(states_ang, prepend=45.) + 45.
+        angles = _bracket_cumsum(turns, is_close, restore, 45.)
+        rad = np.radians(angles[is_move])
+        steps = np.zeros((len(codes), 2))
+        steps[is_move] = np.stack([np.cos(rad), np.sin(rad)], axis=1)
+        steps[0:2 * k + 1:2] = np.diff(states_xy, axis=0, prepend=[[0., 0.]])
+        return _bracket_cumsum(steps, is_close, restore, 0.)[is_move]
+
+
+def walk_generations(lsys, turtle_cls, axiom, n):
+    """
+    Traces of the first n generations of lsys starting from axiom. A single
+    turtle is reset between generations, so its buffers (e.g. the stack) are
+    reused. FractalTree uses the numba walk for generations of at least
+    NATIVE_MIN_SYMBOLS symbols if numba is installed, interpreted feed else.
+    """
+    turtle, traces = turtle_cls(), []
+    for symbols in lsys.iter(axiom, n):
+        turtle.reset(len(symbols) + 1)
+        traces.append(turtle(symbols).numpy())
+    return traces
+
 
 def example_FractalTree(n_epochs=5):
     fractal = Lsys({'1': '11', '0': '1[0]0'})
-    for i, symbols in enumerate(fractal.iter('0', n_epochs)):
-        turtle = FractalTree()  # init again and again?
-        trace = turtle(symbols).numpy()
+    traces = walk_generations(fractal, FractalTree, '0', n_epochs)
+    for i, trace in enumerate(traces):
         plt.figure(i+1)
         plt.scatter(trace[:, 0], trace[:, 1])
         plt.savefig('tree%d.png' % (i + 1))
 
 
 class KochCurve(Turtle):
-    def __init__(self):
-        super(KochCurve, self).__init__()
+    def reset(self, capacity=64):
+        super(KochCurve, self).reset(capacity)
         self.angle = 0
         self.poop()
 
@@ -91,9 +397,8 @@ class KochCurve(Turtle):
 
 def example_KochCurve(n_epochs=5):
     koch_lsys = Lsys({'F': 'F+F-F-F+F'})
-    for i, symbols in enumerate(koch_lsys.iter('F', n_epochs)):
-        turtle = KochCurve()  # init again and again?
-        trace = turtle(symbols).numpy()
+    traces = walk_generations(koch_lsys, KochCurve, 'F', n_epochs)
+    for i, trace in enumerate(traces):
         plt.figure(i+1)
         plt.plot(trace[:, 0], trace[:, 1])
         plt.savefig('koch%d.png' % (i + 1))